@@ -1,15 +1,151 @@
 # ingest.py
+import hashlib
+import json
 import os
 import re
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
 from typing import List
 
 import fitz  # PyMuPDF
+import numpy as np
 import pdfplumber
+import xxhash
+from datasketch import MinHash, MinHashLSH
 from dotenv import load_dotenv
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import Qdrant
 from langchain_core.documents import Document
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
+from qdrant_client import QdrantClient
+from qdrant_client.models import (
+    Distance,
+    HnswConfigDiff,
+    PayloadSchemaType,
+    PointIdsList,
+    PointStruct,
+    ScalarQuantization,
+    ScalarQuantizationConfig,
+    ScalarType,
+    VectorParams,
+    VectorParamsDiff,
+)
+
+# Number of chunks sent to the embedding API (and upserted) per request
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+# Number of points sent to Qdrant per upsert request
+UPSERT_BATCH_SIZE = int(os.getenv("UPSERT_BATCH_SIZE", "256"))
+# Dimension of the vectors produced by models/embedding-001
+EMBEDDING_SIZE = 768
+# int8 scalar quantization kept in RAM; the full fp32 vectors stay on disk
+# and are only read to rescore the top candidates
+QUANTIZATION_CONFIG = ScalarQuantization(
+    scalar=ScalarQuantizationConfig(type=ScalarType.INT8, quantile=0.99, always_ram=True)
+)
+HNSW_CONFIG = HnswConfigDiff(m=16, ef_construct=128)
+# Local SQLite cache of chunk embeddings, reused across re-ingests
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", "embed_cache.sqlite")
+
+# Regex captures section, service name, and service ID
+_SERVICE_RE = re.compile(
+    r'(\d{1,2}\.\d{1,2})\s+([\w\d]+)\s+\(0x([0-9A-Fa-f]+)\)\s+service',
+    re.IGNORECASE,
+)
+
+# Pages handed to a worker at once
+PAGES_PER_JOB = 4
+
+# Per-worker cache of open (fitz, pdfplumber) documents, keyed by path.
+# Opening is expensive (pdfplumber walks the whole page tree), so each
+# worker process opens a document once and reuses it for every job. Memory
+# stays bounded because every pdfplumber page is closed after use.
+_DOC_CACHE = {}
+
+
+def _has_table_geometry(fitz_page) -> bool:
+    """
+    Cheap check for ruled tables using PyMuPDF's vector drawings.
+    Pages with no lines and fewer than 4 rectangles are treated as prose.
+    """
+    lines = rects = 0
+    for drawing in fitz_page.get_drawings():
+        for item in drawing["items"]:
+            if item[0] == "l":
+                lines += 1
+            elif item[0] == "re":
+                rects += 1
+    return lines > 0 or rects >= 4
+
+
+def _format_page(page_num: int, page_text: str, tables: list, service_metadata: dict):
+    """
+    Combine page text and tables into a single page-level entry.
+    Returns (page_num, page_content, metadata) with a 0-based page_num.
+    """
+    tables_text_list = []
+    for table in tables:
+        # Skip tables with no text in any cell; they only add blank rows to embed
+        if not table or not any(any(c for c in r) for r in table):
+            continue
+        cleaned_rows = [" | ".join("" if c is None else c for c in row) for row in table]
+        tables_text_list.append("\n".join(cleaned_rows))
+
+    tables_text = "\n\n".join(tables_text_list)
+
+    # Combine text and tables for the current page
+    page_content = f"## Page Text\n{page_text.strip()}\n\n## Page Tables\n{tables_text}"
+
+    page_metadata = service_metadata.copy()
+    page_metadata["page"] = page_num + 1  # human-friendly numbering
+
+    return page_num, page_content, page_metadata
+
+
+def _extract_page(page, service_metadata: dict):
+    """Extract text and tables of a single pdfplumber page."""
+    page_text = page.extract_text() or ""
+    tables = page.extract_tables()
+    return _format_page(page.page_number - 1, page_text, tables, service_metadata)
+
+
+def _worker_docs(pdf_path: str):
+    """Return this worker's (fitz, pdfplumber) documents, opening them on first use."""
+    docs = _DOC_CACHE.get(pdf_path)
+    if docs is None:
+        docs = _DOC_CACHE[pdf_path] = (fitz.open(pdf_path), pdfplumber.open(pdf_path))
+    return docs
+
+
+def _extract_pages(pdf_path: str, page_nums: List[int], service_metadata: dict):
+    """
+    Extract a batch of pages inside a worker process.
+    Table-free pages are read with PyMuPDF's C text extractor; only pages
+    with table geometry go through pdfplumber, and each such page is closed
+    (dropping its cached objects and text map) as soon as it has been processed.
+    Pages beyond the end of the document are silently skipped.
+    """
+    doc, pdf = _worker_docs(pdf_path)
+    n_pages = len(doc)
+
+    results = []
+    for page_num in page_nums:
+        if page_num >= n_pages:
+            continue
+        fitz_page = doc.load_page(page_num)
+        if _has_table_geometry(fitz_page):
+            page = pdf.pages[page_num]
+            results.append(_extract_page(page, service_metadata))
+            # close() also clears the get_textmap cache, which flush_cache()
+            # leaves holding every char object of the page
+            page.close()
+        else:
+            results.append(_format_page(page_num, fitz_page.get_text(), [], service_metadata))
+    return results
+
+
+def _extract_pages_job(job: tuple):
+    """Unpack a (pdf_path, page_nums, service_metadata) job for executor.map."""
+    return _extract_pages(*job)
 
 
 def parse_iso14229_pdf(pdf_path: str) -> List[Document]:
@@ -20,33 +156,26 @@ def parse_iso14229_pdf(pdf_path: str) -> List[Document]:
     """
     print(f"Parsing ISO14229 PDF: {pdf_path}")
 
-    # Regex captures section, service name, and service ID
-    service_patterns = [
-        r'(\d{1,2}\.\d{1,2})\s+([\w\d]+)\s+\(0x([0-9A-Fa-f]+)\)\s+service'
-    ]
-
     page_docs: List[Document] = []
     service_index = {}
 
     # Step 1: Use PyMuPDF to detect service start pages and define page ranges
     doc = fitz.open(pdf_path)
-    for page_num in range(len(doc)):
-        text = doc.load_page(page_num).get_text()
-        text = re.sub(r'\s+', ' ', text)  # normalize whitespace
-
-        for pattern in service_patterns:
-            matches = re.findall(pattern, text, flags=re.IGNORECASE)
-            for match in matches:
-                section_num, service_name, service_id_hex = match
-                service_id = f"0x{service_id_hex}"
-
-                # Overwrite ensures we skip index entries and keep actual definition later
-                service_index[service_name] = {
-                    "service_name": service_name,
-                    "service_id": service_id,
-                    "section": section_num,
-                    "start": page_num
-                }
+    n_pages = len(doc)
+    for page_num in range(n_pages):
+        # No whitespace normalization needed: the pattern already matches \s+
+        text = doc.load_page(page_num).get_text("text")
+
+        for section_num, service_name, service_id_hex in _SERVICE_RE.findall(text):
+            service_id = f"0x{service_id_hex}"
+
+            # Overwrite ensures we skip index entries and keep actual definition later
+            service_index[service_name] = {
+                "service_name": service_name,
+                "service_id": service_id,
+                "section": section_num,
+                "start": page_num
+            }
 
     # Convert dict → sorted list by page number
     page_ranges = list(service_index.values())
@@ -60,53 +189,245 @@ def parse_iso14229_pdf(pdf_path: str) -> List[Document]:
         if i < len(page_ranges) - 1:
             page_ranges[i]["end"] = page_ranges[i + 1]["start"]
         else:
-            page_ranges[i]["end"] = len(doc)
+            page_ranges[i]["end"] = n_pages
     doc.close()
 
-    # Step 2: Extract content page by page using PDFPlumber
-    with pdfplumber.open(pdf_path) as pdf:
-        for info in page_ranges:
-            # --- This metadata applies to all pages in this range ---
-            service_metadata = {
-                "service_name": info["service_name"],
-                "service_id": info["service_id"],
-                "section": info["section"]
-            }
+    # Step 2: Extract content page by page (PyMuPDF for prose, PDFPlumber for tables).
+    # Layout analysis is CPU-bound, so pages are spread across processes.
+    jobs = []
+    for info in page_ranges:
+        # --- This metadata applies to all pages in this range ---
+        service_metadata = {
+            "service_name": info["service_name"],
+            "service_id": info["service_id"],
+            "section": info["section"]
+        }
+        for first in range(info["start"], info["end"], PAGES_PER_JOB):
+            page_nums = list(range(first, min(first + PAGES_PER_JOB, info["end"])))
+            jobs.append((pdf_path, page_nums, service_metadata))
 
-            for page_num in range(info["start"], info["end"]):
-                if page_num >= len(pdf.pages):
-                    continue
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        results = [r for batch in executor.map(_extract_pages_job, jobs) for r in batch]
 
-                page = pdf.pages[page_num]
-                page_text = page.extract_text() or ""
+    # Preserve document order regardless of which worker finished first
+    results.sort(key=lambda r: r[0])
+    for _, page_content, page_metadata in results:
+        page_docs.append(Document(page_content=page_content, metadata=page_metadata))
 
-                # Extract tables from the page
-                tables = page.extract_tables()
-                tables_text_list = []
-                for table in tables:
-                    cleaned_rows = [
-                        " | ".join(map(lambda cell: '' if cell is None else cell, row))
-                        for row in table
-                    ]
-                    tables_text_list.append("\n".join(cleaned_rows))
+    print(f"Extracted {len(page_docs)} page-level documents from the PDF.")
+    return page_docs
 
-                tables_text = "\n\n".join(tables_text_list)
 
-                # Combine text and tables for the current page
-                page_content = f"## Page Text\n{page_text.strip()}\n\n## Page Tables\n{tables_text}"
+def _minhash(text: str, num_perm: int) -> MinHash:
+    """MinHash signature over the word 5-shingles of a chunk."""
+    words = text.split()
+    shingles = {" ".join(words[i:i + 5]) for i in range(max(len(words) - 4, 1))}
+    m = MinHash(num_perm=num_perm)
+    for shingle in shingles:
+        m.update(shingle.encode("utf-8"))
+    return m
 
-                # --- Create a Document for EACH page ---
-                page_metadata = service_metadata.copy()
-                page_metadata["page"] = page_num + 1  # human-friendly numbering
 
-                page_doc = Document(
-                    page_content=page_content,
-                    metadata=page_metadata
-                )
-                page_docs.append(page_doc)
+def dedup_chunks(
+    chunks: List[Document],
+    threshold: float = 0.9,
+    num_perm: int = 64,
+) -> List[Document]:
+    """
+    Drop near-duplicate chunks (repeated headers, footers, boilerplate)
+    before embedding. A chunk is skipped when an earlier chunk's MinHash
+    has an estimated Jaccard similarity at or above the threshold.
+    """
+    lsh = MinHashLSH(threshold=threshold, num_perm=num_perm)
+    signatures = {}
+    unique: List[Document] = []
+    for i, chunk in enumerate(chunks):
+        m = _minhash(chunk.page_content, num_perm)
+        # LSH only yields candidates; confirm before dropping to rule out
+        # banding false positives
+        if any(m.jaccard(signatures[key]) >= threshold for key in lsh.query(m)):
+            continue
+        key = str(i)
+        lsh.insert(key, m)
+        signatures[key] = m
+        unique.append(chunk)
 
-    print(f"Extracted {len(page_docs)} page-level documents from the PDF.")
-    return page_docs
+    dropped = len(chunks) - len(unique)
+    ratio = dropped / len(chunks) if chunks else 0.0
+    print(f"Dropped {dropped} near-duplicate chunks ({ratio:.1%}).")
+    return unique
+
+
+def _cache_key(text: str, model_name: str) -> bytes:
+    """
+    Key an embedding by its exact input text and the model that produced it.
+    xxh64 is plenty for a local cache and much cheaper than SHA-256. Caches
+    written with the old SHA-256 keys simply miss once and are re-embedded.
+    """
+    return xxhash.xxh64(text.encode("utf-8") + b"\0" + model_name.encode("utf-8")).digest()
+
+
+def _point_id(text: str, metadata: dict) -> int:
+    """
+    Deterministic Qdrant point id for a chunk, so re-ingesting identical
+    content overwrites the existing point instead of adding a duplicate.
+    """
+    digest = hashlib.sha256(
+        (text + json.dumps(metadata, sort_keys=True)).encode("utf-8")
+    ).digest()
+    return int.from_bytes(digest[:8], "big")
+
+
+def embed_with_cache(
+    conn: sqlite3.Connection,
+    embeddings: GoogleGenerativeAIEmbeddings,
+    texts: List[str],
+    batch_size: int = EMBED_BATCH_SIZE,
+) -> List[List[float]]:
+    """
+    Return one vector per text, in order.
+    Vectors are looked up in the local SQLite cache first; only cache misses
+    are sent to the embedding API (in batches) and then stored.
+    """
+    conn.execute("CREATE TABLE IF NOT EXISTS embeddings (hash BLOB PRIMARY KEY, vec BLOB)")
+
+    keys = [_cache_key(t, embeddings.model) for t in texts]
+    vectors: List[List[float] | None] = [None] * len(texts)
+    misses = []
+    for i, key in enumerate(keys):
+        row = conn.execute("SELECT vec FROM embeddings WHERE hash = ?", (key,)).fetchone()
+        if row is None:
+            misses.append(i)
+        else:
+            vectors[i] = np.frombuffer(row[0], dtype=np.float32).tolist()
+
+    print(f"Embedding cache: {len(texts) - len(misses)} hits, {len(misses)} misses.")
+
+    for start in range(0, len(misses), batch_size):
+        batch = misses[start:start + batch_size]
+
+        # One embedding request per batch instead of one per chunk
+        vecs = embeddings.embed_documents([texts[i] for i in batch])
+
+        conn.executemany(
+            "INSERT OR REPLACE INTO embeddings (hash, vec) VALUES (?, ?)",
+            [(keys[i], np.asarray(v, dtype=np.float32).tobytes()) for i, v in zip(batch, vecs)],
+        )
+        conn.commit()
+        for i, vec in zip(batch, vecs):
+            vectors[i] = vec
+
+    return vectors
+
+
+def _delete_stale_points(client: QdrantClient, collection_name: str, keep_ids: set) -> int:
+    """
+    Delete every point whose id is not in keep_ids, i.e. chunks left over
+    from an earlier ingest whose content has since changed or been dropped.
+    Returns the number of points deleted.
+    """
+    stale = []
+    offset = None
+    while True:
+        points, offset = client.scroll(
+            collection_name=collection_name,
+            limit=1000,
+            offset=offset,
+            with_payload=False,
+            with_vectors=False,
+        )
+        stale.extend(p.id for p in points if p.id not in keep_ids)
+        if offset is None:
+            break
+
+    if stale:
+        client.delete(
+            collection_name=collection_name,
+            points_selector=PointIdsList(points=stale),
+            wait=True,
+        )
+    return len(stale)
+
+
+def upload_chunks(
+    client: QdrantClient,
+    collection_name: str,
+    chunks: List[Document],
+    embeddings: GoogleGenerativeAIEmbeddings,
+    batch_size: int = EMBED_BATCH_SIZE,
+    cache_path: str = EMBED_CACHE_PATH,
+    upsert_batch_size: int = UPSERT_BATCH_SIZE,
+) -> int:
+    """
+    Embed chunks (reusing cached vectors) and upsert them into the collection,
+    creating it on first use. Points from earlier ingests that are not part of
+    the current chunk set are deleted afterwards. Payloads keep the LangChain layout
+    (page_content + metadata) so the retriever in agent.py can read them back.
+    """
+    if not client.collection_exists(collection_name):
+        client.create_collection(
+            collection_name=collection_name,
+            vectors_config=VectorParams(size=EMBEDDING_SIZE, distance=Distance.COSINE, on_disk=True),
+            quantization_config=QUANTIZATION_CONFIG,
+            hnsw_config=HNSW_CONFIG,
+        )
+    else:
+        # Bring collections created before quantization was enabled up to date,
+        # including moving their fp32 vectors to disk
+        client.update_collection(
+            collection_name=collection_name,
+            vectors_config={"": VectorParamsDiff(on_disk=True)},
+            quantization_config=QUANTIZATION_CONFIG,
+            hnsw_config=HNSW_CONFIG,
+        )
+
+    # agent.py filters on the service id for queries like "what is the 0x22
+    # service?" and orders the matches by page, which needs an integer index
+    client.create_payload_index(
+        collection_name=collection_name,
+        field_name="metadata.service_id",
+        field_schema=PayloadSchemaType.KEYWORD,
+    )
+    client.create_payload_index(
+        collection_name=collection_name,
+        field_name="metadata.page",
+        field_schema=PayloadSchemaType.INTEGER,
+    )
+
+    texts = [c.page_content for c in chunks]
+    metadatas = [c.metadata for c in chunks]
+
+    with closing(sqlite3.connect(cache_path)) as conn:
+        vectors = embed_with_cache(conn, embeddings, texts, batch_size)
+
+    ids = [_point_id(text, meta) for text, meta in zip(texts, metadatas)]
+
+    uploaded = 0
+    for i in range(0, len(texts), upsert_batch_size):
+        points = [
+            PointStruct(
+                id=point_id,
+                vector=vec,
+                payload={"page_content": text, "metadata": meta},
+            )
+            for point_id, text, meta, vec in zip(
+                ids[i:i + upsert_batch_size],
+                texts[i:i + upsert_batch_size],
+                metadatas[i:i + upsert_batch_size],
+                vectors[i:i + upsert_batch_size],
+            )
+        ]
+        # Stream batches without waiting; only the last one waits, which
+        # flushes everything queued before it
+        is_last = i + upsert_batch_size >= len(texts)
+        client.upsert(collection_name=collection_name, points=points, wait=is_last)
+        uploaded += len(points)
+        print(f"Uploaded {uploaded}/{len(texts)} chunks...")
+
+    deleted = _delete_stale_points(client, collection_name, set(ids))
+    print(f"Deleted {deleted} stale points.")
+
+    return uploaded
 
 
 # --- MAIN EXECUTION LOGIC ---
@@ -129,6 +450,7 @@ if __name__ == "__main__":
             chunk_overlap=200,
         )
         final_chunks = text_splitter.split_documents(page_level_docs)
+        final_chunks = dedup_chunks(final_chunks)
         print(f"Created a total of {len(final_chunks)} chunks for embedding.")
 
         # 3. Initialize Gemini Embeddings
@@ -136,12 +458,6 @@ if __name__ == "__main__":
 
         # 4. Upload to Qdrant
         print("Uploading document chunks to Qdrant...")
-        Qdrant.from_documents(
-            final_chunks,
-            embeddings,
-            url=qdrant_url,
-            api_key=qdrant_api_key,
-            collection_name=collection_name,
-            force_recreate=True,
-        )
-        print(f"Successfully uploaded {len(final_chunks)} chunks to collection '{collection_name}'.")
+        client = QdrantClient(url=qdrant_url, api_key=qdrant_api_key, prefer_grpc=True, timeout=30)
+        uploaded = upload_chunks(client, collection_name, final_chunks, embeddings)
+        print(f"Successfully uploaded {uploaded} chunks to collection '{collection_name}'.")
@@ -1,17 +1,28 @@
 # agent.py
 import os
+import re
 from typing import TypedDict, Annotated, List
 from langchain_core.messages import BaseMessage
 from dotenv import load_dotenv
 
 # --- 1. Load Environment Variables ---
-load_dotenv()
-
-# Check if necessary API keys are set
-if "GOOGLE_API_KEY" not in os.environ:
-    raise ValueError("Google API key not found in .env file")
-if "OPENWEATHERMAP_API_KEY" not in os.environ:
-    raise ValueError("OpenWeatherMap API key not found in .env file")
+# Loading and checking happen on first use (see the factories below), so
+# importing this module stays cheap, e.g. for the unit tests.
+_env_loaded = False
+
+def _load_env():
+    """Loads the .env file the first time it is needed."""
+    global _env_loaded
+    if not _env_loaded:
+        load_dotenv()
+        _env_loaded = True
+
+def _require_env(key: str, description: str) -> str:
+    """Returns the given environment variable, raising if it is not set."""
+    _load_env()
+    if key not in os.environ:
+        raise ValueError(f"{description} not found in .env file")
+    return os.environ[key]
 
 # --- 2. Define the State for our Graph ---
 
@@ -26,108 +37,325 @@ class AgentState(TypedDict):
     weather_data: dict | None # <-- ADD THIS LINE
     route: str # <-- ADD THIS LINE
 
-import requests
+import asyncio
+
+import httpx
+from cachetools import LRUCache, TTLCache
 from langchain_qdrant import Qdrant
 from langchain_google_genai import GoogleGenerativeAIEmbeddings, ChatGoogleGenerativeAI
 from pydantic import BaseModel, Field
-from qdrant_client import QdrantClient
+from qdrant_client import AsyncQdrantClient, QdrantClient
+from qdrant_client.models import (
+    Direction,
+    FieldCondition,
+    Filter,
+    MatchAny,
+    OrderBy,
+    QuantizationSearchParams,
+    SearchParams,
+)
 # --- 3. Define Tools ---
 
 # Tool for fetching weather
 class WeatherInput(BaseModel):
     city: str = Field(description="The city to get the weather for.")
 
-def fetch_weather(city: str) -> dict:
-    """Fetches real-time weather data for a given city."""
-    base_url = "http://api.openweathermap.org/data/2.5/weather"
-    params = {
+# Shared async client so the connection to OpenWeatherMap stays warm between calls.
+# It must be used from a single long-lived event loop (see main.py).
+# Pool limits go on the transport: httpx ignores client-level limits when a
+# transport is passed.
+_HTTP = httpx.AsyncClient(
+    timeout=5,
+    transport=httpx.AsyncHTTPTransport(
+        retries=2,
+        limits=httpx.Limits(max_keepalive_connections=4, max_connections=8),
+    ),
+)
+
+# OpenWeatherMap updates roughly every 10 minutes, so recent lookups are reused
+_WEATHER_CACHE = TTLCache(maxsize=256, ttl=600)
+
+WEATHER_URL = "http://api.openweathermap.org/data/2.5/weather"
+
+def _weather_params(city: str) -> dict:
+    """Builds the OpenWeatherMap query parameters for a city."""
+    return {
         "q": city,
-        "appid": os.getenv("OPENWEATHERMAP_API_KEY"),
+        "appid": _require_env("OPENWEATHERMAP_API_KEY", "OpenWeatherMap API key"),
         "units": "metric"  # Use Celsius
     }
+
+async def fetch_weather(city: str) -> dict:
+    """Fetches real-time weather data for a given city."""
+    cache_key = city.strip().lower()
+    cached = _WEATHER_CACHE.get(cache_key)
+    if cached is not None:
+        return cached
+
     try:
-        response = requests.get(base_url, params=params)
-        response.raise_for_status()  # Raises an HTTPError for bad responses (4xx or 5xx)
-        return response.json()
-    except requests.exceptions.HTTPError as http_err:
+        response = await _HTTP.get(WEATHER_URL, params=_weather_params(city))
+        response.raise_for_status()  # Raises an HTTPStatusError for bad responses (4xx or 5xx)
+        data = response.json()
+        _WEATHER_CACHE[cache_key] = data  # Only successful lookups are cached
+        return data
+    except httpx.HTTPStatusError as http_err:
         if response.status_code == 404:
             return {"error": f"City '{city}' not found."}
         else:
             return {"error": f"HTTP error occurred: {http_err}"}
-    except requests.exceptions.RequestException as req_err:
+    except httpx.HTTPError as req_err:
         return {"error": f"An error occurred: {req_err}"}
 
 # Tool for RAG
-# First, set up the necessary components for our retriever
-llm = ChatGoogleGenerativeAI(model="models/gemini-2.0-flash")
-embeddings = GoogleGenerativeAIEmbeddings(model="models/embedding-001")
-qdrant_url = os.getenv("QDRANT_URL")
-qdrant_api_key = os.getenv("QDRANT_API_KEY")
 collection_name = "iso14229_uds_pages"
 
-# Initialize the Qdrant vector store
-client = QdrantClient(
-    url=qdrant_url,
-    api_key=qdrant_api_key,
-)
-
-# 2. Initialize the LangChain Qdrant wrapper
-qdrant_store = Qdrant(
-    client=client,
-    collection_name=collection_name,
-    embeddings=embeddings,
+# Search the int8-quantized index, then rescore 2x the requested hits with the
+# original vectors so recall stays close to fp32
+search_params = SearchParams(
+    quantization=QuantizationSearchParams(rescore=True, oversampling=2.0)
 )
 
-# Create the retriever
-retriever = qdrant_store.as_retriever(
-    search_type="similarity",
-    search_kwargs={"k": 5} # Retrieve the top 5 most similar documents
-)
+# The LLM, embeddings and Qdrant clients are created lazily by the factories
+# below and then reused for the lifetime of the process.
+_llm = None
+_embeddings = None
+_client = None
+_aclient = None
+_retriever = None
+
+def get_llm() -> ChatGoogleGenerativeAI:
+    """Returns the shared Gemini chat model."""
+    global _llm
+    if _llm is None:
+        _require_env("GOOGLE_API_KEY", "Google API key")
+        _llm = ChatGoogleGenerativeAI(model="models/gemini-2.0-flash")
+    return _llm
+
+def get_embeddings() -> GoogleGenerativeAIEmbeddings:
+    """Returns the shared Gemini embeddings model."""
+    global _embeddings
+    if _embeddings is None:
+        _require_env("GOOGLE_API_KEY", "Google API key")
+        _embeddings = GoogleGenerativeAIEmbeddings(model="models/embedding-001")
+    return _embeddings
+
+def get_qdrant_client() -> QdrantClient:
+    """Returns the shared synchronous Qdrant client."""
+    global _client
+    if _client is None:
+        _load_env()
+        _client = QdrantClient(
+            url=os.getenv("QDRANT_URL"),
+            api_key=os.getenv("QDRANT_API_KEY"),
+        )
+    return _client
+
+def get_async_qdrant_client() -> AsyncQdrantClient:
+    """Returns the shared async Qdrant client used by the graph nodes."""
+    global _aclient
+    if _aclient is None:
+        _load_env()
+        _aclient = AsyncQdrantClient(
+            url=os.getenv("QDRANT_URL"),
+            api_key=os.getenv("QDRANT_API_KEY"),
+        )
+    return _aclient
 
 def get_rag_retriever():
     """Returns the configured Qdrant retriever for RAG."""
-    return retriever
-
-# --- 4. Define Graph Nodes ---
+    global _retriever
+    if _retriever is None:
+        # Initialize the LangChain Qdrant wrapper
+        qdrant_store = Qdrant(
+            client=get_qdrant_client(),
+            async_client=get_async_qdrant_client(),
+            collection_name=collection_name,
+            embeddings=get_embeddings(),
+        )
+        # Create the retriever
+        _retriever = qdrant_store.as_retriever(
+            search_type="similarity",
+            search_kwargs={"k": 5} # Retrieve the top 5 most similar documents
+        )
+    return _retriever
+
+# Query embeddings keyed by normalized query text
+_QUERY_EMBED_CACHE = LRUCache(maxsize=1024)
+
+async def _embed_query(norm_query: str) -> tuple:
+    """Embeds a normalized query once; repeated queries reuse the cached vector."""
+    vector = _QUERY_EMBED_CACHE.get(norm_query)
+    if vector is None:
+        vector = tuple(await get_embeddings().aembed_query(norm_query))
+        _QUERY_EMBED_CACHE[norm_query] = vector
+    return vector
+
+# Matches a query that explicitly names a UDS service by id, e.g. "the 0x22
+# service" or "service 0x22". Bare values (NRCs, sub-functions) don't match.
+_SERVICE_ID_RE = re.compile(
+    r'\bservice\s+(?:id\s+)?\(?0x([0-9a-f]{2})\b|\b0x([0-9a-f]{2})\)?\s+service\b', re.I
+)
 
-def router_node(state: AgentState) -> dict:
+async def search_documents(query: str, k: int = 5) -> List[str]:
     """
-    Decides the next step and updates the 'route' field in the state.
+    Returns the page_content of up to k chunks relevant to the query.
+    Queries naming a service id are answered with the opening pages of that
+    service's section (payload filter ordered by page), skipping the
+    embedding call entirely. If that finds nothing or fails, Qdrant is
+    searched directly with a cached query embedding instead of going through
+    the LangChain retriever.
     """
-    print("---ROUTER ---")
-    query = state["query"]
-    prompt = f"""Given the user query, should I use the 'weather_tool' for real-time weather information 
-    or the 'rag_tool' for answering questions based on the provided ISO 14229-1 document?
+    m = _SERVICE_ID_RE.search(query)
+    if m:
+        hex_id = m.group(1) or m.group(2)
+        # Service ids keep the case used in the PDF, so match both spellings
+        service_filter = Filter(must=[FieldCondition(
+            key="metadata.service_id",
+            match=MatchAny(any=[f"0x{hex_id.lower()}", f"0x{hex_id.upper()}"]),
+        )])
+        try:
+            points, _ = await get_async_qdrant_client().scroll(
+                collection_name=collection_name,
+                scroll_filter=service_filter,
+                limit=k,
+                order_by=OrderBy(key="metadata.page", direction=Direction.ASC),
+                with_payload=True,
+            )
+        except Exception as err:
+            # e.g. a collection ingested before the metadata.page index existed
+            print(f"Service filter failed, falling back to vector search: {err}")
+            points = []
+        if points:
+            return [point.payload["page_content"] for point in points]
+
+    query_vector = await _embed_query(normalize_query(query))
+    response = await get_async_qdrant_client().query_points(
+        collection_name=collection_name,
+        query=list(query_vector),
+        limit=k,
+        search_params=search_params,
+        with_payload=True,
+    )
+    return [point.payload["page_content"] for point in response.points]
+
+# --- 4. Define Graph Nodes ---
+
+# Keyword classifier for unambiguous queries; the LLM only breaks ties
+_WEATHER_RE = re.compile(
+    r'\b(weather|temperature|temp|forecast|rain|humidity|wind|climate|hot|cold)\b', re.I
+)
+_RAG_RE = re.compile(r'\b(iso|14229|uds|dtc|diagnostic|service|0x[0-9a-f]+)\b', re.I)
+
+# Routing decisions keyed by normalized query text
+_ROUTE_CACHE = LRUCache(maxsize=512)
+
+# Constant parts of the prompts, hoisted so each call only splices in the
+# variable pieces
+_ROUTER_PREFIX = """Given the user query, should I use the 'weather_tool' for real-time weather information 
+or the 'rag_tool' for answering questions based on the provided ISO 14229-1 document?
+
+User Query: \""""
+_ROUTER_SUFFIX = """"
+
+Respond with only 'weather' or 'rag'.
+"""
+
+# Tie-breaker for queries that hit both keyword sets, e.g. "cold reset" in an
+# ECUReset question; 'both' only when the query really needs a city's weather
+_TIEBREAK_PREFIX = """The user query mentions both weather-related and ISO 14229-1 related terms.
+Should I use the 'weather_tool' for real-time weather information, the 'rag_tool' for
+answering questions based on the ISO 14229-1 document, or both? Only choose 'both' if
+the query names a city or location whose current weather is needed.
+
+User Query: \""""
+_TIEBREAK_SUFFIX = """"
+
+Respond with only 'weather', 'rag' or 'both'.
+"""
 
-    User Query: "{query}"
+_BOTH_PREFIX = """Answer the user's question using the context from the ISO 14229-1
+document and the real-time weather data below. Use whichever parts are relevant.
 
-    Respond with only 'weather' or 'rag'.
+Context:
+"""
+_BOTH_WEATHER = """
+
+Weather data:
+"""
+_RAG_PREFIX = """Based on the following context from the ISO 14229-1 document, 
+provide a concise answer to the user's question.
+
+Context:
+"""
+_QUESTION = """
+
+Question:
+"""
+_WEATHER_PREFIX = """The user asked: \""""
+_WEATHER_DATA = """"
+Here is the real-time weather data: """
+_WEATHER_SUFFIX = """.
+
+Generate a friendly, conversational response summarizing this weather information.
+If there is an error in the data, state it clearly.
+"""
+
+def normalize_query(query: str) -> str:
+    """Lowercases the query and collapses whitespace so near-identical queries share a cache entry."""
+    return re.sub(r'\s+', ' ', query.lower()).strip()
+
+async def _classify(norm_query: str) -> str:
     """
+    Returns 'weather', 'rag' or 'both' for a normalized query.
+    Queries that hit exactly one keyword set are classified directly. The
+    LLM decides the rest: overlapping queries may be sent to both tools,
+    queries with no keywords go to one of them.
+    """
+    is_weather = _WEATHER_RE.search(norm_query) is not None
+    is_rag = _RAG_RE.search(norm_query) is not None
+    if is_weather and not is_rag:
+        return "weather"
+    if is_rag and not is_weather:
+        return "rag"
+    if is_weather and is_rag:
+        prompt = _TIEBREAK_PREFIX + norm_query + _TIEBREAK_SUFFIX
+    else:
+        prompt = _ROUTER_PREFIX + norm_query + _ROUTER_SUFFIX
 
-    response = llm.invoke(prompt)
+    response = await get_llm().ainvoke(prompt)
     decision = response.content.strip().lower()
+    if is_weather and is_rag and "both" in decision:
+        return "both"
+    return "weather" if "weather" in decision else "rag"
+
+async def _route(norm_query: str) -> str:
+    """Cached wrapper around _classify, so repeated queries skip the LLM round-trip."""
+    decision = _ROUTE_CACHE.get(norm_query)
+    if decision is None:
+        decision = await _classify(norm_query)
+        _ROUTE_CACHE[norm_query] = decision
+    return decision
+
+async def router_node(state: AgentState) -> dict:
+    """
+    Decides the next step and updates the 'route' field in the state.
+    """
+    print("---ROUTER ---")
+    decision = await _route(normalize_query(state["query"]))
     print(f"Router decision: '{decision}'")
+    return {"route": decision}
 
-    if "weather" in decision:
-        return {"route": "weather"}
-    else:
-        return {"route": "rag"}
-
-def rag_node(state: AgentState) -> dict:
+async def rag_node(state: AgentState) -> dict:
     """
     Retrieves documents from the Qdrant database based on the query.
     """
     print("---RETRIEVING FROM RAG ---")
-    query = state["query"]
-    docs = retriever.invoke(query)
-    
-    # Format documents for clarity in the final prompt
-    documents_content = [doc.page_content for doc in docs]
+    documents_content = await search_documents(state["query"])
     print(f"Retrieved {len(documents_content)} documents.")
     
     return {"documents": documents_content, "sender": "RAG Tool"}
 
-def weather_node(state: AgentState) -> dict:
+async def weather_node(state: AgentState) -> dict:
     """
     Extracts the city from the query and fetches weather data.
     """
@@ -135,18 +363,45 @@ def weather_node(state: AgentState) -> dict:
     query = state["query"]
     
     # Use the LLM with a structured output to reliably get the city name
-    structured_llm = llm.with_structured_output(WeatherInput)
-    result = structured_llm.invoke(query)
+    structured_llm = get_llm().with_structured_output(WeatherInput)
+    result = await structured_llm.ainvoke(query)
     
-    if not result.city:
+    # The structured LLM returns None when it makes no tool call
+    if result is None or not result.city:
         return {"weather_data": {"error": "Could not identify a city in the query."}, "sender": "Weather Tool"}
 
     print(f"City identified: {result.city}")
-    weather_info = fetch_weather(result.city)
+    weather_info = await fetch_weather(result.city)
     
     return {"weather_data": weather_info, "sender": "Weather Tool"}
 
-def response_generator_node(state: AgentState) -> dict:
+async def both_node(state: AgentState) -> dict:
+    """
+    Runs the RAG retrieval and the weather lookup concurrently for queries
+    that need both, so the faster call is hidden behind the slower one.
+    If the weather half fails or returns an error, the answer falls back to
+    the retrieved documents alone.
+    """
+    print("---RETRIEVING FROM RAG AND FETCHING WEATHER ---")
+    rag_result, weather_result = await asyncio.gather(
+        rag_node(state), weather_node(state), return_exceptions=True
+    )
+    if isinstance(rag_result, BaseException):
+        raise rag_result
+
+    weather_data = None
+    if isinstance(weather_result, BaseException):
+        print(f"Weather lookup failed, answering from documents only: {weather_result!r}")
+    elif "error" not in weather_result["weather_data"]:
+        weather_data = weather_result["weather_data"]
+
+    return {
+        "documents": rag_result["documents"],
+        "weather_data": weather_data,
+        "sender": "RAG Tool + Weather Tool" if weather_data else "RAG Tool",
+    }
+
+async def response_generator_node(state: AgentState) -> dict:
     """
     Generates a final, human-readable response based on the gathered information.
     """
@@ -155,30 +410,24 @@ def response_generator_node(state: AgentState) -> dict:
     documents = state.get("documents")
     weather_data = state.get("weather_data")
 
-    if documents:
-        # Generate response using RAG context
+    if documents and weather_data:
+        # Generate response using both the RAG context and the weather data
         context = "\n\n".join(documents)
-        prompt = f"""Based on the following context from the ISO 14229-1 document, 
-        provide a concise answer to the user's question.
-
-        Context:
-        {context}
+        prompt = "".join((_BOTH_PREFIX, context, _BOTH_WEATHER, str(weather_data), _QUESTION, query))
+        response = await get_llm().ainvoke(prompt)
+        return {"response": response.content, "sender": "Agent"}
 
-        Question:
-        {query}
-        """
-        response = llm.invoke(prompt)
+    elif documents:
+        # Generate response using RAG context
+        context = "\n\n".join(documents)
+        prompt = "".join((_RAG_PREFIX, context, _QUESTION, query))
+        response = await get_llm().ainvoke(prompt)
         return {"response": response.content, "sender": "Agent"}
     
     elif weather_data:
         # Generate response using weather data
-        prompt = f"""The user asked: "{query}"
-        Here is the real-time weather data: {weather_data}.
-        
-        Generate a friendly, conversational response summarizing this weather information.
-        If there is an error in the data, state it clearly.
-        """
-        response = llm.invoke(prompt)
+        prompt = "".join((_WEATHER_PREFIX, query, _WEATHER_DATA, str(weather_data), _WEATHER_SUFFIX))
+        response = await get_llm().ainvoke(prompt)
         return {"response": response.content, "sender": "Agent"}
     
     else:
@@ -196,6 +445,7 @@ workflow = StateGraph(AgentState)
 workflow.add_node("router", router_node)
 workflow.add_node("rag_tool", rag_node)
 workflow.add_node("weather_tool", weather_node)
+workflow.add_node("both_tool", both_node)
 workflow.add_node("responder", response_generator_node)
 
 # Set the entry point for the graph
@@ -210,11 +460,13 @@ workflow.add_conditional_edges(
     {
         "rag": "rag_tool",
         "weather": "weather_tool",
+        "both": "both_tool",
     },)
 # Define the normal edges
 # After a tool is called, the flow always goes to the responder
 workflow.add_edge("rag_tool", "responder")
 workflow.add_edge("weather_tool", "responder")
+workflow.add_edge("both_tool", "responder")
 
 # The responder is the final step, so we connect it to the END
 workflow.add_edge("responder", END)
@@ -227,28 +479,31 @@ app = workflow.compile()
 if __name__ == "__main__":
     from langchain_core.messages import HumanMessage
 
-    # --- Example 1: RAG Query ---
-    rag_query = "what is Diagnostic Trouble Code?"
-    inputs = {
-        "messages": [HumanMessage(content=rag_query)],
-        "query": rag_query  # <-- ADD THIS KEY
-    }
-    
-    print("---Testing RAG Query ---")
-    for output in app.stream(inputs, stream_mode="values"):
-        print(output)
-        print("---")
-    
-    print("" + "="*30 + "")
-
-    # --- Example 2: Weather Query ---
-    weather_query = "what is the weather like in Bengaluru?"
-    inputs = {
-        "messages": [HumanMessage(content=weather_query)],
-        "query": weather_query # <-- ADD THIS KEY
-    }
-
-    print("---Testing Weather Query ---")
-    for output in app.stream(inputs, stream_mode="values"):
-        print(output)
-        print("---")
\ No newline at end of file
+    async def run_examples():
+        # --- Example 1: RAG Query ---
+        rag_query = "what is Diagnostic Trouble Code?"
+        inputs = {
+            "messages": [HumanMessage(content=rag_query)],
+            "query": rag_query  # <-- ADD THIS KEY
+        }
+
+        print("---Testing RAG Query ---")
+        async for output in app.astream(inputs, stream_mode="values"):
+            print(output)
+            print("---")
+
+        print("" + "="*30 + "")
+
+        # --- Example 2: Weather Query ---
+        weather_query = "what is the weather like in Bengaluru?"
+        inputs = {
+            "messages": [HumanMessage(content=weather_query)],
+            "query": weather_query # <-- ADD THIS KEY
+        }
+
+        print("---Testing Weather Query ---")
+        async for output in app.astream(inputs, stream_mode="values"):
+            print(output)
+            print("---")
+
+    asyncio.run(run_examples())
@@ -1,4 +1,7 @@
 # main.py
+import asyncio
+import threading
+
 import streamlit as st
 from langchain_core.messages import HumanMessage, AIMessage
 
@@ -10,6 +13,65 @@ st.set_page_config(page_title="AI Weather & Document Assistant", layout="wide")
 st.title("AI Weather & Document Assistant")
 st.info("Ask about the weather or query the ISO 14229-1 document.")
 
+# --- Shared Event Loop ---
+# The agent's async HTTP and Qdrant clients are kept open between requests,
+# so every session runs the graph on one long-lived background event loop.
+@st.cache_resource
+def get_event_loop():
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+async def _response_tokens(inputs):
+    """
+    Runs the agent and yields the responder's tokens as they are generated.
+    If nothing was streamed (e.g. the fallback reply), yields the final response.
+    """
+    streamed = False
+    final_state = {}
+    async for mode, payload in app.astream(inputs, stream_mode=["messages", "values"]):
+        if mode == "messages":
+            chunk, metadata = payload
+            # Only the responder's output is shown; router/tool LLM calls are skipped
+            if metadata.get("langgraph_node") == "responder" and chunk.content:
+                streamed = True
+                yield chunk.content
+        else:
+            final_state = payload
+    if not streamed:
+        yield final_state.get("response", "I'm sorry, I encountered an error.")
+
+def stream_response(inputs):
+    """
+    Synchronous generator over _response_tokens for st.write_stream.
+    Shows a spinner until the first token arrives, and closes the async
+    generator (stopping the graph run) if Streamlit abandons the stream.
+    """
+    loop = get_event_loop()
+    tokens = _response_tokens(inputs)
+    pending = None
+    try:
+        first = True
+        while True:
+            pending = asyncio.run_coroutine_threadsafe(tokens.__anext__(), loop)
+            try:
+                if first:
+                    with st.spinner("Thinking..."):
+                        token = pending.result()
+                    first = False
+                else:
+                    token = pending.result()
+            except StopAsyncIteration:
+                break
+            yield token
+    finally:
+        if pending is not None and not pending.done():
+            # Cancelling the in-flight step raises CancelledError inside the
+            # generator, which finishes it (aclose() would fail while it runs)
+            pending.cancel()
+        else:
+            asyncio.run_coroutine_threadsafe(tokens.aclose(), loop)
+
 # --- Session State for Chat History ---
 # This will keep the conversation history in memory
 if "messages" not in st.session_state:
@@ -27,22 +89,15 @@ if prompt := st.chat_input("What would you like to know?"):
     with st.chat_message("user"):
         st.markdown(prompt)
 
-    # Show a spinner while the agent is thinking
-    with st.spinner("Thinking..."):
-        # Prepare the input for the LangGraph agent
-        inputs = {
-            "messages": [HumanMessage(content=prompt)],
-            "query": prompt
-        }
-        
-        # Invoke the agent to get the final response
-        # We use .invoke() for the final result, not .stream()
-        result = app.invoke(inputs)
-        
-        # Extract the final response from the agent's output
-        final_response = result.get("response", "I'm sorry, I encountered an error.")
-
-    # Add the agent's response to session state and display it
-    st.session_state.messages.append(AIMessage(content=final_response))
+    # Prepare the input for the LangGraph agent
+    inputs = {
+        "messages": [HumanMessage(content=prompt)],
+        "query": prompt
+    }
+
+    # Stream the agent's response token by token as it is generated
     with st.chat_message("ai"):
-        st.markdown(final_response)
\ No newline at end of file
+        final_response = st.write_stream(stream_response(inputs))
+
+    # Add the agent's response to session state
+    st.session_state.messages.append(AIMessage(content=final_response))
\ No newline at end of file
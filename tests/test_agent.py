@@ -1,31 +1,263 @@
 # tests/test_agent.py
+import asyncio
 import pytest
-from agent import router_node
+from agent import (
+    router_node,
+    rag_node,
+    both_node,
+    response_generator_node,
+    WeatherInput,
+    _ROUTE_CACHE,
+    _QUERY_EMBED_CACHE,
+)
 from langchain_core.messages import AIMessage
 
+@pytest.fixture(autouse=True)
+def clear_router_cache():
+    """Ensures cached routing decisions and query embeddings don't leak between tests."""
+    _ROUTE_CACHE.clear()
+    _QUERY_EMBED_CACHE.clear()
+    yield
+    _ROUTE_CACHE.clear()
+    _QUERY_EMBED_CACHE.clear()
+
 def test_router_node_routes_to_rag(mocker):
     """Tests if the router correctly decides 'rag' for a document-related query."""
-    # Mock the llm.invoke method to return a predictable AIMessage
+    # Mock the llm.ainvoke method to return a predictable AIMessage
     mock_llm = mocker.Mock()
-    mock_llm.invoke.return_value = AIMessage(content="rag")
-    # This replaces the actual LLM in the agent.py file with our mock for this test
-    mocker.patch("agent.llm", mock_llm)
+    mock_llm.ainvoke = mocker.AsyncMock(return_value=AIMessage(content="rag"))
+    # This makes agent.py hand out our mock instead of creating the real LLM
+    mocker.patch("agent.get_llm", return_value=mock_llm)
 
-    # Define a sample state
-    state = {"query": "What is a Diagnostic Trouble Code?"}
+    # Define a sample state; no routing keywords, so the LLM decides
+    state = {"query": "What does a tester send to open a programming session?"}
 
     # Call the router node
-    result = router_node(state)
+    result = asyncio.run(router_node(state))
 
-    # Check if the decision is correct
+    # Check if the decision is correct and came from the LLM
     assert result == {"route": "rag"}
+    mock_llm.ainvoke.assert_called_once()
 
 def test_router_node_routes_to_weather(mocker):
     """Tests if the router correctly decides 'weather' for a weather-related query."""
     mock_llm = mocker.Mock()
-    mock_llm.invoke.return_value = AIMessage(content="weather")
-    mocker.patch("agent.llm", mock_llm)
+    mock_llm.ainvoke = mocker.AsyncMock(return_value=AIMessage(content="weather"))
+    mocker.patch("agent.get_llm", return_value=mock_llm)
+
+    # No routing keywords, so the LLM decides
+    state = {"query": "Is it sunny in Bengaluru today?"}
+    result = asyncio.run(router_node(state))
+    assert result == {"route": "weather"}
+    mock_llm.ainvoke.assert_called_once()
+
+def test_router_node_weather_keyword_skips_llm(mocker):
+    """Tests that an obvious weather query is routed without calling the LLM."""
+    mock_llm = mocker.Mock()
+    mock_llm.ainvoke = mocker.AsyncMock()
+    mocker.patch("agent.get_llm", return_value=mock_llm)
+
+    result = asyncio.run(router_node({"query": "Will it rain in Mysuru?"}))
+    assert result == {"route": "weather"}
+    mock_llm.ainvoke.assert_not_called()
+
+def test_router_node_caches_normalized_query(mocker):
+    """Tests that repeated queries differing only in case/whitespace reuse the cached decision."""
+    mock_llm = mocker.Mock()
+    mock_llm.ainvoke = mocker.AsyncMock(return_value=AIMessage(content="rag"))
+    mocker.patch("agent.get_llm", return_value=mock_llm)
+
+    assert asyncio.run(router_node({"query": "How does session switching work?"})) == {"route": "rag"}
+    assert asyncio.run(router_node({"query": "  how does session   SWITCHING work? "})) == {"route": "rag"}
+    mock_llm.ainvoke.assert_called_once()
+
+def test_router_node_rag_keyword_skips_llm(mocker):
+    """Tests that an obvious document query is routed without calling the LLM."""
+    mock_llm = mocker.Mock()
+    mock_llm.ainvoke = mocker.AsyncMock()
+    mocker.patch("agent.get_llm", return_value=mock_llm)
+
+    result = asyncio.run(router_node({"query": "What does the 0x22 request return?"}))
+    assert result == {"route": "rag"}
+    mock_llm.ainvoke.assert_not_called()
+
+def test_router_node_routes_to_both(mocker):
+    """Tests that the LLM tie-breaker can send an overlapping query to both tools."""
+    mock_llm = mocker.Mock()
+    mock_llm.ainvoke = mocker.AsyncMock(return_value=AIMessage(content="both"))
+    mocker.patch("agent.get_llm", return_value=mock_llm)
+
+    result = asyncio.run(router_node({"query": "Will it rain in Pune, and what is the 0x22 service?"}))
+    assert result == {"route": "both"}
+    mock_llm.ainvoke.assert_called_once()
+
+def test_router_node_overlap_without_city_routes_to_rag(mocker):
+    """Tests that an overlapping query the LLM judges document-only is not fanned out."""
+    mock_llm = mocker.Mock()
+    mock_llm.ainvoke = mocker.AsyncMock(return_value=AIMessage(content="rag"))
+    mocker.patch("agent.get_llm", return_value=mock_llm)
+
+    result = asyncio.run(router_node({"query": "What is a cold reset in the ECUReset service?"}))
+    assert result == {"route": "rag"}
+    mock_llm.ainvoke.assert_called_once()
+
+def test_router_node_unknown_query_uses_llm(mocker):
+    """Tests that a query matching neither keyword set falls back to the LLM."""
+    mock_llm = mocker.Mock()
+    mock_llm.ainvoke = mocker.AsyncMock(return_value=AIMessage(content="weather"))
+    mocker.patch("agent.get_llm", return_value=mock_llm)
+
+    result = asyncio.run(router_node({"query": "Should I carry an umbrella in Pune?"}))
+    assert result == {"route": "weather"}
+    mock_llm.ainvoke.assert_called_once()
+
+def test_rag_node_reuses_query_embedding(mocker):
+    """Tests that the RAG node searches Qdrant directly and embeds a repeated query only once."""
+    mock_embeddings = mocker.Mock()
+    mock_embeddings.aembed_query = mocker.AsyncMock(return_value=[0.1, 0.2])
+    mocker.patch("agent.get_embeddings", return_value=mock_embeddings)
+    mock_client = mocker.Mock()
+    mock_client.query_points = mocker.AsyncMock(
+        return_value=mocker.Mock(points=[mocker.Mock(payload={"page_content": "DTC definition"})])
+    )
+    mocker.patch("agent.get_async_qdrant_client", return_value=mock_client)
+
+    state = {"query": "What is a DTC?"}
+    assert asyncio.run(rag_node(state))["documents"] == ["DTC definition"]
+    assert asyncio.run(rag_node(state))["documents"] == ["DTC definition"]
+
+    mock_embeddings.aembed_query.assert_called_once()
+    assert mock_client.query_points.call_args.kwargs["query"] == [0.1, 0.2]
+
+def test_rag_node_filters_by_service_id(mocker):
+    """Tests that a query naming a service id is answered by a payload filter without embedding."""
+    mock_embeddings = mocker.Mock()
+    mock_embeddings.aembed_query = mocker.AsyncMock()
+    mocker.patch("agent.get_embeddings", return_value=mock_embeddings)
+    mock_client = mocker.Mock()
+    mock_client.scroll = mocker.AsyncMock(
+        return_value=([mocker.Mock(payload={"page_content": "ReadDataByIdentifier"})], None)
+    )
+    mock_client.query_points = mocker.AsyncMock()
+    mocker.patch("agent.get_async_qdrant_client", return_value=mock_client)
+
+    result = asyncio.run(rag_node({"query": "What is the 0x22 service?"}))
+
+    assert result["documents"] == ["ReadDataByIdentifier"]
+    mock_embeddings.aembed_query.assert_not_called()
+    mock_client.query_points.assert_not_called()
+    assert mock_client.scroll.call_args.kwargs["order_by"].key == "metadata.page"
+
+def test_rag_node_service_filter_falls_through_when_empty(mocker):
+    """Tests that an empty service-id filter result falls back to vector search."""
+    mock_embeddings = mocker.Mock()
+    mock_embeddings.aembed_query = mocker.AsyncMock(return_value=[0.1, 0.2])
+    mocker.patch("agent.get_embeddings", return_value=mock_embeddings)
+    mock_client = mocker.Mock()
+    mock_client.scroll = mocker.AsyncMock(return_value=([], None))
+    mock_client.query_points = mocker.AsyncMock(
+        return_value=mocker.Mock(points=[mocker.Mock(payload={"page_content": "vector hit"})])
+    )
+    mocker.patch("agent.get_async_qdrant_client", return_value=mock_client)
+
+    result = asyncio.run(rag_node({"query": "What is the 0x99 service?"}))
+
+    assert result["documents"] == ["vector hit"]
+    mock_client.scroll.assert_called_once()
+    mock_client.query_points.assert_called_once()
+
+def test_rag_node_service_filter_falls_through_on_error(mocker):
+    """Tests that a rejected service-id scroll (e.g. missing page index) falls back to vector search."""
+    mock_embeddings = mocker.Mock()
+    mock_embeddings.aembed_query = mocker.AsyncMock(return_value=[0.1, 0.2])
+    mocker.patch("agent.get_embeddings", return_value=mock_embeddings)
+    mock_client = mocker.Mock()
+    mock_client.scroll = mocker.AsyncMock(side_effect=RuntimeError("No range index for order_by key"))
+    mock_client.query_points = mocker.AsyncMock(
+        return_value=mocker.Mock(points=[mocker.Mock(payload={"page_content": "vector hit"})])
+    )
+    mocker.patch("agent.get_async_qdrant_client", return_value=mock_client)
+
+    result = asyncio.run(rag_node({"query": "What is the 0x22 service?"}))
+
+    assert result["documents"] == ["vector hit"]
+    mock_client.query_points.assert_called_once()
+
+def test_rag_node_bare_hex_value_uses_vector_search(mocker):
+    """Tests that a hex value that isn't named as a service (e.g. an NRC) skips the service filter."""
+    mock_embeddings = mocker.Mock()
+    mock_embeddings.aembed_query = mocker.AsyncMock(return_value=[0.1, 0.2])
+    mocker.patch("agent.get_embeddings", return_value=mock_embeddings)
+    mock_client = mocker.Mock()
+    mock_client.scroll = mocker.AsyncMock()
+    mock_client.query_points = mocker.AsyncMock(
+        return_value=mocker.Mock(points=[mocker.Mock(payload={"page_content": "NRC table"})])
+    )
+    mocker.patch("agent.get_async_qdrant_client", return_value=mock_client)
+
+    result = asyncio.run(rag_node({"query": "What does NRC 0x11 mean?"}))
+
+    assert result["documents"] == ["NRC table"]
+    mock_client.scroll.assert_not_called()
+
+def test_both_node_merges_rag_and_weather(mocker):
+    """Tests that the combined node runs both tools and merges their outputs."""
+    mocker.patch("agent.search_documents", mocker.AsyncMock(return_value=["0x22 definition"]))
+    mocker.patch("agent.fetch_weather", mocker.AsyncMock(return_value={"main": {"temp": 25}}))
+    mock_llm = mocker.Mock()
+    mock_llm.with_structured_output.return_value.ainvoke = mocker.AsyncMock(
+        return_value=WeatherInput(city="Pune")
+    )
+    mocker.patch("agent.get_llm", return_value=mock_llm)
+
+    result = asyncio.run(both_node({"query": "Weather in Pune and the 0x22 service?"}))
+
+    assert result["documents"] == ["0x22 definition"]
+    assert result["weather_data"] == {"main": {"temp": 25}}
+
+def test_both_node_falls_back_to_documents_when_weather_fails(mocker):
+    """Tests that a failing weather lookup doesn't fail the request when retrieval worked."""
+    mocker.patch("agent.search_documents", mocker.AsyncMock(return_value=["0x22 definition"]))
+    mocker.patch("agent.fetch_weather", mocker.AsyncMock(side_effect=ValueError("no API key")))
+    mock_llm = mocker.Mock()
+    mock_llm.with_structured_output.return_value.ainvoke = mocker.AsyncMock(
+        return_value=WeatherInput(city="Pune")
+    )
+    mocker.patch("agent.get_llm", return_value=mock_llm)
+
+    result = asyncio.run(both_node({"query": "Weather in Pune and the 0x22 service?"}))
+
+    assert result["documents"] == ["0x22 definition"]
+    assert result["weather_data"] is None
+
+def test_both_node_drops_weather_without_city(mocker):
+    """Tests that a missing city (no structured output) leaves a documents-only answer."""
+    mocker.patch("agent.search_documents", mocker.AsyncMock(return_value=["0x22 definition"]))
+    mock_fetch = mocker.patch("agent.fetch_weather", mocker.AsyncMock())
+    mock_llm = mocker.Mock()
+    mock_llm.with_structured_output.return_value.ainvoke = mocker.AsyncMock(return_value=None)
+    mocker.patch("agent.get_llm", return_value=mock_llm)
+
+    result = asyncio.run(both_node({"query": "Is it cold, and what is the 0x22 service?"}))
+
+    assert result["documents"] == ["0x22 definition"]
+    assert result["weather_data"] is None
+    mock_fetch.assert_not_called()
+
+def test_response_generator_uses_documents_and_weather(mocker):
+    """Tests that the responder includes both the RAG context and the weather data in its prompt."""
+    mock_llm = mocker.Mock()
+    mock_llm.ainvoke = mocker.AsyncMock(return_value=AIMessage(content="combined answer"))
+    mocker.patch("agent.get_llm", return_value=mock_llm)
+
+    state = {
+        "query": "Weather in Pune and the 0x22 service?",
+        "documents": ["0x22 definition"],
+        "weather_data": {"main": {"temp": 25}},
+    }
+    result = asyncio.run(response_generator_node(state))
 
-    state = {"query": "What is the weather in Bengaluru?"}
-    result = router_node(state)
-    assert result == {"route": "weather"}
\ No newline at end of file
+    assert result["response"] == "combined answer"
+    prompt = mock_llm.ainvoke.call_args.args[0]
+    assert "0x22 definition" in prompt
+    assert "'temp': 25" in prompt
@@ -0,0 +1,49 @@
+# tests/test_ingest.py
+import sqlite3
+from langchain_core.documents import Document
+from INGEST import dedup_chunks, embed_with_cache, _delete_stale_points
+
+def test_embed_with_cache_only_embeds_misses(mocker):
+    """Tests that cached texts are not re-embedded and vectors come back in input order."""
+    mock_embeddings = mocker.Mock()
+    mock_embeddings.model = "models/embedding-001"
+    mock_embeddings.embed_documents.side_effect = lambda texts: [[float(len(t))] for t in texts]
+    conn = sqlite3.connect(":memory:")
+
+    # First run: everything is a miss
+    assert embed_with_cache(conn, mock_embeddings, ["a", "bb"]) == [[1.0], [2.0]]
+    mock_embeddings.embed_documents.assert_called_once_with(["a", "bb"])
+
+    # Second run: only the new text is sent to the API
+    mock_embeddings.embed_documents.reset_mock()
+    result = embed_with_cache(conn, mock_embeddings, ["bb", "ccc", "a"])
+
+    assert result == [[2.0], [3.0], [1.0]]
+    mock_embeddings.embed_documents.assert_called_once_with(["ccc"])
+
+def test_delete_stale_points_removes_unknown_ids(mocker):
+    """Tests that points not produced by the current ingest are deleted."""
+    mock_client = mocker.Mock()
+    mock_client.scroll.side_effect = [
+        ([mocker.Mock(id=1), mocker.Mock(id="old-uuid")], "next"),
+        ([mocker.Mock(id=2)], None),
+    ]
+
+    deleted = _delete_stale_points(mock_client, "test", {1, 2})
+
+    assert deleted == 1
+    selector = mock_client.delete.call_args.kwargs["points_selector"]
+    assert selector.points == ["old-uuid"]
+
+def test_dedup_chunks_drops_near_duplicates():
+    """Tests that a near-identical chunk is dropped while distinct chunks survive."""
+    body = " ".join(f"word{i}" for i in range(200))
+    original = Document(page_content=body, metadata={"page": 1})
+    near_copy = Document(page_content=body + " footer", metadata={"page": 2})
+    distinct = Document(
+        page_content=" ".join(f"other{i}" for i in range(200)), metadata={"page": 3}
+    )
+
+    result = dedup_chunks([original, near_copy, distinct])
+
+    assert [c.metadata["page"] for c in result] == [1, 3]
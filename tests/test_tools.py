@@ -1,18 +1,27 @@
 # tests/test_tools.py
+import asyncio
 import pytest
-import requests
-from agent import fetch_weather
+import httpx
+from agent import fetch_weather, _WEATHER_CACHE
+
+@pytest.fixture(autouse=True)
+def clear_weather_cache(monkeypatch):
+    """Ensures cached weather lookups don't leak between tests."""
+    monkeypatch.setenv("OPENWEATHERMAP_API_KEY", "test-key")
+    _WEATHER_CACHE.clear()
+    yield
+    _WEATHER_CACHE.clear()
 
 def test_fetch_weather_success(mocker):
     """Tests the fetch_weather function for a successful API call."""
-    # Mock the requests.get call to simulate a successful response
+    # Mock the client's get call to simulate a successful response
     mock_response = mocker.Mock()
     mock_response.status_code = 200
     mock_response.json.return_value = {"main": {"temp": 25}, "weather": [{"description": "haze"}]}
-    mocker.patch("requests.get", return_value=mock_response)
+    mocker.patch("agent._HTTP.get", mocker.AsyncMock(return_value=mock_response))
 
     # Call the function
-    result = fetch_weather("Bengaluru")
+    result = asyncio.run(fetch_weather("Bengaluru"))
 
     # Check if the result is what we expect
     assert result["main"]["temp"] == 25
@@ -20,15 +29,30 @@ def test_fetch_weather_success(mocker):
 
 def test_fetch_weather_city_not_found(mocker):
     """Tests the fetch_weather function for a 404 'Not Found' error."""
-    # Mock the requests.get call to simulate an error
+    # Mock the client's get call to simulate an error
     mock_response = mocker.Mock()
     mock_response.status_code = 404
-    mock_response.raise_for_status.side_effect = requests.exceptions.HTTPError
-    mocker.patch("requests.get", return_value=mock_response)
+    mock_response.raise_for_status.side_effect = httpx.HTTPStatusError(
+        "Not Found", request=mocker.Mock(), response=mock_response
+    )
+    mocker.patch("agent._HTTP.get", mocker.AsyncMock(return_value=mock_response))
 
     # Call the function with a city that doesn't exist
-    result = fetch_weather("Atlantis")
+    result = asyncio.run(fetch_weather("Atlantis"))
 
     # Check if the error is handled correctly
     assert "error" in result
-    assert "City 'Atlantis' not found" in result["error"]
\ No newline at end of file
+    assert "City 'Atlantis' not found" in result["error"]
+
+def test_fetch_weather_uses_cache(mocker):
+    """Tests that a repeated lookup for the same city is served from the cache."""
+    mock_response = mocker.Mock()
+    mock_response.status_code = 200
+    mock_response.json.return_value = {"main": {"temp": 25}}
+    mock_get = mocker.patch("agent._HTTP.get", mocker.AsyncMock(return_value=mock_response))
+
+    asyncio.run(fetch_weather("Bengaluru"))
+    result = asyncio.run(fetch_weather(" bengaluru "))
+
+    assert result["main"]["temp"] == 25
+    mock_get.assert_called_once()